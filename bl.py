@@ -1,56 +1,262 @@
 #!/usr/bin/env python3
 
 import argparse
-from pypdf import PdfReader, PdfWriter, PageObject
+import os
+import shutil
+import subprocess
+import tempfile
+import warnings
+from contextlib import ExitStack
 
+import pikepdf
 
-def page_two_up(left: PageObject, right: PageObject) -> PageObject:
+
+def _num(value) -> bytes:
+    """
+    Formats a number for use as an operand in a PDF content stream.
+
+    >>> _num(612), _num(-10.5), _num(-0.0)
+    (b'612', b'-10.5', b'0')
     """
-    Prints two PageObjects in a 2-up format.
+    # Adding 0.0 turns -0.0 into 0.0
+    return f'{float(value) + 0.0:f}'.rstrip('0').rstrip('.').encode() or b'0'
+
+
+def page_two_up(pdf: pikepdf.Pdf, left: pikepdf.Page, right: pikepdf.Page,
+                mediaboxes: dict|None = None) -> pikepdf.Page:
+    """
+    Prints two Pages in a 2-up format.
+
+    Each source page is wrapped in a Form XObject and drawn by a short, fixed
+    content stream, so the source content streams are referenced rather than
+    parsed and rewritten. As with a plain merge, a source page's /Rotate and
+    /UserUnit are ignored. The new page belongs to `pdf` but is not added to
+    its page list.
 
     Args:
+        pdf: The document that will own the new page.
         left: The first page to print.
         right: The second page to print.
+        mediaboxes: A cache of sheet MediaBox arrays keyed by page size. When
+            given, sheets of the same size share a single MediaBox. (optional)
 
     Returns:
-        The merged PageObject representing the two pages printed 2-up.
+        The new Page representing the two pages printed 2-up.
 
     Create two blank pages
-    >>> import pypdf as p
-    >>> page1 = p.PageObject.create_blank_page(width=200, height=300)
-    >>> page2 = p.PageObject.create_blank_page(width=200, height=300)
+    >>> import pikepdf as p
+    >>> src = p.new()
+    >>> page1 = src.add_blank_page(page_size=(200, 300))
+    >>> page2 = src.add_blank_page(page_size=(200, 300))
 
     Merge the pages
-    >>> merged_page = page_two_up(page1, page2)
+    >>> dst = p.new()
+    >>> merged_page = page_two_up(dst, page1, page2)
 
     Verify the result
-    >>> assert isinstance(merged_page, PageObject)
-    >>> assert merged_page.mediabox.width == 400
-    >>> assert merged_page.mediabox.height == 300
+    >>> assert isinstance(merged_page, p.Page)
+    >>> assert merged_page.mediabox == [0, 0, 400, 300]
+    >>> assert not merged_page.MediaBox.is_indirect
+    >>> assert len(dst.pages) == 0
+
+    Sheets of the same size can share one MediaBox
+    >>> mediaboxes = {}
+    >>> sheet1 = page_two_up(dst, page1, page2, mediaboxes)
+    >>> sheet2 = page_two_up(dst, page2, page1, mediaboxes)
+    >>> assert sheet1.MediaBox.objgen == sheet2.MediaBox.objgen
+
+    A rotated page is placed unrotated, within its own half
+    >>> page4 = src.add_blank_page(page_size=(200, 300))
+    >>> page4.Rotate = 90
+    >>> rotated = page_two_up(dst, page4, page1)
+    >>> assert '/Matrix' not in rotated.Resources.XObject.L
+    >>> rotated.Contents.read_bytes()
+    b'q 1 0 0 1 0 0 cm /L Do Q q 1 0 0 1 200 0 cm /R Do Q'
+
+    A page printed on both sides is only wrapped once
+    >>> twice = page_two_up(dst, page1, page1)
+    >>> sorted(twice.Resources.XObject.keys())
+    ['/L']
 
     The two pages must be the same size
-    # >>> page3 = p.PageObject.create_blank_page(width=200, height=400)
-    # >>> page_two_up(page1, page3)
-    # Traceback (most recent call last):
-    #     ...
-    # AssertionError: The two pages must be the same size
-    #     ...
+    >>> page3 = src.add_blank_page(page_size=(200, 400))
+    >>> page_two_up(dst, page1, page3)
+    Traceback (most recent call last):
+        ...
+    AssertionError: The two pages must be the same size
     """
-    # Get the dimensions of the first page
-    width = left.mediabox.width
-    height = left.mediabox.height
+    # Get the dimensions of the first page, as floats rather than Decimals
+    mediabox = left.mediabox
+    x0, y0, x1, y1 = (float(v) for v in mediabox)
+    width = x1 - x0
+    height = y1 - y0
+
+    assert mediabox == right.mediabox, "The two pages must be the same size"
+
+    # Wrap each source page in a Form XObject; a page used on both sides is
+    # wrapped once and drawn twice. The placement below assumes the unrotated
+    # MediaBox, so /Rotate and /UserUnit must not be applied to the form.
+    xobjects = pikepdf.Dictionary(
+        L=pdf.copy_foreign(left.as_form_xobject(handle_transformations=False)))
+    if left.obj.objgen != right.obj.objgen or left.obj.objgen == (0, 0):
+        xobjects.R = pdf.copy_foreign(right.as_form_xobject(handle_transformations=False))
+        right_name = b'/R'
+    else:
+        right_name = b'/L'
+
+    # Draw the left page at the origin and the right page one width over
+    contents = b'q 1 0 0 1 %s %s cm /L Do Q q 1 0 0 1 %s %s cm %s Do Q' % (
+        _num(-x0), _num(-y0), _num(width - x0), _num(-y0), right_name)
 
-    assert left.mediabox == right.mediabox, "The two pages must be the same size"
+    # Only a cached MediaBox is made indirect, so that sheets can share it
+    if mediaboxes is None:
+        sheet_mediabox = pikepdf.Array([0, 0, width * 2, height])
+    elif (width, height) in mediaboxes:
+        sheet_mediabox = mediaboxes[(width, height)]
+    else:
+        sheet_mediabox = pdf.make_indirect(pikepdf.Array([0, 0, width * 2, height]))
+        mediaboxes[(width, height)] = sheet_mediabox
 
-    # Create a new PageObject from the merged pages
-    output_page = PageObject.create_blank_page(width=width * 2, height=height)
-    output_page.merge_page(left)
-    output_page.merge_translated_page(right, tx=width, ty=0)
+    output_page = pikepdf.Page(pdf.make_indirect(pikepdf.Dictionary(
+        Type=pikepdf.Name.Page,
+        MediaBox=sheet_mediabox,
+        Contents=pdf.make_stream(contents),
+        Resources=pikepdf.Dictionary(XObject=xobjects),
+    )))
 
     return output_page
 
 
-def create_booklet(input_path: str, centerfold_path: str|None, output_path: str) -> None:
+def imposition_order(total_pages: int) -> list[tuple[int, int]]:
+    """
+    Computes the saddle-stitch order of the pages in a booklet.
+
+    Args:
+        total_pages: The number of pages in the input document.
+
+    Returns:
+        A list of (left, right) page indexes, one pair per 2-up page.
+
+    >>> imposition_order(8)
+    [(7, 0), (1, 6), (5, 2), (3, 4)]
+    >>> imposition_order(6)
+    [(5, 0), (1, 4), (3, 2)]
+    """
+    last = total_pages - 1
+    order = []
+    for i in range(total_pages // 2):
+        if i % 2 == 0:
+            order.append((last - i, i))
+        else:
+            order.append((i, last - i))
+    return order
+
+
+def _qpdf_npages(path: str) -> int:
+    """
+    Counts the pages in a PDF document using the qpdf command-line tool.
+    """
+    result = subprocess.run(['qpdf', '--show-npages', path],
+                            check=True, capture_output=True, text=True)
+    return int(result.stdout)
+
+
+def create_booklet_qpdf(input_path: str, centerfold_path: str|None, output_path: str,
+                        compress: bool = False) -> None:
+    """
+    Converts a PDF document into booklet form using the external pdfbook2 and
+    qpdf tools, without building any PDF objects in Python.
+
+    pdfbook2 imposes the input onto letter-size sheets for flip-on-short-edge
+    printing, scaling the pages to fit and padding the page count to a multiple
+    of four with blank pages. If a centerfold is given, qpdf appends it to the
+    booklet, rotated as in create_booklet().
+
+    Args:
+        input_path (str): The path to the input PDF document.
+        centerfold_path (str): The path to the centerfold PDF document. (optional)
+        output_path (str): The path to save the output booklet PDF.
+        compress (bool): Have qpdf recompress all streams at level 9.
+
+    Raises:
+        subprocess.CalledProcessError: If pdfbook2 or qpdf fails.
+
+    Run with the tools and the file system mocked out, printing the commands
+    >>> from unittest import mock
+    >>> npages = {'/tmp/bl/booklet-book.pdf': 4, 'cf1.pdf': 1, 'cf3.pdf': 3}
+    >>> def run(cmd, **kwargs):
+    ...     if cmd[1] == '--show-npages':
+    ...         return subprocess.CompletedProcess(cmd, 0, stdout=str(npages[cmd[2]]))
+    ...     print(*cmd)
+    >>> def booklet(centerfold_path, compress):
+    ...     with (mock.patch('subprocess.run', side_effect=run),
+    ...           mock.patch('shutil.copyfile') as copyfile,
+    ...           mock.patch('shutil.move') as move,
+    ...           mock.patch('tempfile.TemporaryDirectory') as tmp_dir):
+    ...         tmp_dir.return_value.__enter__.return_value = '/tmp/bl'
+    ...         create_booklet_qpdf('in.pdf', centerfold_path, 'out.pdf', compress)
+    ...     print('copy', *copyfile.call_args.args)
+    ...     if move.called:
+    ...         print('move', *move.call_args.args)
+
+    Without a centerfold or compression pdfbook2's output is used as is
+    >>> booklet(None, False)
+    pdfbook2 --paper=letterpaper --short-edge --no-crop /tmp/bl/booklet.pdf
+    copy in.pdf /tmp/bl/booklet.pdf
+    move /tmp/bl/booklet-book.pdf out.pdf
+
+    Otherwise qpdf writes the output
+    >>> booklet(None, True)
+    pdfbook2 --paper=letterpaper --short-edge --no-crop /tmp/bl/booklet.pdf
+    qpdf --empty --pages /tmp/bl/booklet-book.pdf --
+         --recompress-flate --compression-level=9 out.pdf
+    copy in.pdf /tmp/bl/booklet.pdf
+
+    Centerfold pages are rotated alternately by +90 and -90 degrees
+    >>> booklet('cf1.pdf', False)
+    pdfbook2 --paper=letterpaper --short-edge --no-crop /tmp/bl/booklet.pdf
+    qpdf --empty --pages /tmp/bl/booklet-book.pdf cf1.pdf -- --rotate=+90:5 out.pdf
+    copy in.pdf /tmp/bl/booklet.pdf
+    >>> booklet('cf3.pdf', True)
+    pdfbook2 --paper=letterpaper --short-edge --no-crop /tmp/bl/booklet.pdf
+    qpdf --empty --pages /tmp/bl/booklet-book.pdf cf3.pdf --
+         --rotate=+90:5,7 --rotate=-90:6 --recompress-flate --compression-level=9 out.pdf
+    copy in.pdf /tmp/bl/booklet.pdf
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # pdfbook2 writes NAME-book.pdf next to its input
+        booklet_input = os.path.join(tmp_dir, 'booklet.pdf')
+        shutil.copyfile(input_path, booklet_input)
+        subprocess.run(['pdfbook2', '--paper=letterpaper', '--short-edge', '--no-crop',
+                        booklet_input], check=True, capture_output=True)
+        booklet_path = os.path.join(tmp_dir, 'booklet-book.pdf')
+
+        if not centerfold_path and not compress:
+            shutil.move(booklet_path, output_path)
+            return
+
+        cmd = ['qpdf', '--empty', '--pages', booklet_path]
+        if centerfold_path:
+            first = _qpdf_npages(booklet_path) + 1
+            last = first + _qpdf_npages(centerfold_path) - 1
+            clockwise = ','.join(str(n) for n in range(first, last + 1, 2))
+            counterclockwise = ','.join(str(n) for n in range(first + 1, last + 1, 2))
+
+            cmd += [centerfold_path, '--']
+            if clockwise:
+                cmd.append(f'--rotate=+90:{clockwise}')
+            if counterclockwise:
+                cmd.append(f'--rotate=-90:{counterclockwise}')
+        else:
+            cmd.append('--')
+        if compress:
+            cmd += ['--recompress-flate', '--compression-level=9']
+        cmd.append(output_path)
+        subprocess.run(cmd, check=True, capture_output=True)
+
+
+def create_booklet(input_path: str, centerfold_path: str|None, output_path: str,
+                   engine: str = 'pikepdf', compress: bool = False) -> None:
     """
     Converts a PDF document into booklet form. The resulting PDF will 
     contain half the number of pages as the input document, each page twice the size
@@ -67,60 +273,141 @@ def create_booklet(input_path: str, centerfold_path: str|None, output_path: str)
         input_path (str): The path to the input PDF document.
         centerfold_path (str): The path to the centerfold PDF document. (optional)
         output_path (str): The path to save the output booklet PDF.
+        engine (str): 'pikepdf' (default), or 'qpdf' to use create_booklet_qpdf()
+            when pdfbook2 (and, for a centerfold or compression, qpdf) is on the PATH.
+            The qpdf engine always prints on letter-size sheets, scaling the pages
+            to fit. It falls back to the pikepdf engine, with a warning, if the
+            input has an odd number of pages, or if a centerfold is given and the
+            page count is not a multiple of four, since pdfbook2 would pad the
+            input with blank pages.
+        compress (bool): Recompress all streams when saving. This makes a smaller
+            file but costs CPU time. The pikepdf engine uses pikepdf's current
+            flate level (see pikepdf.settings.set_flate_compression_level), which
+            the command line sets to 9; the qpdf engine always uses level 9.
 
     Raises:
         FileNotFoundError: If the input file does not exist.
         AssertionError: If the input file has an odd number of pages.
         AssertionError: If the input file has variable page sizes.
+
+    Create a 6-page input document and a centerfold
+    >>> import tempfile, warnings
+    >>> from unittest import mock
+    >>> tmp_dir = tempfile.TemporaryDirectory()
+    >>> input_path = os.path.join(tmp_dir.name, 'in.pdf')
+    >>> centerfold_path = os.path.join(tmp_dir.name, 'cf.pdf')
+    >>> output_path = os.path.join(tmp_dir.name, 'out.pdf')
+    >>> with pikepdf.new() as pdf:
+    ...     for _ in range(6):
+    ...         _ = pdf.add_blank_page(page_size=(200, 300))
+    ...     pdf.save(input_path)
+    >>> with pikepdf.new() as pdf:
+    ...     _ = pdf.add_blank_page(page_size=(400, 300))
+    ...     pdf.save(centerfold_path)
+    >>> def qpdf_engine(centerfold_path, compress, which):
+    ...     with (mock.patch('shutil.which', side_effect=which),
+    ...           mock.patch('subprocess.run') as run,
+    ...           warnings.catch_warnings(record=True) as caught):
+    ...         warnings.simplefilter('always')
+    ...         create_booklet(input_path, centerfold_path, output_path, 'qpdf', compress)
+    ...     assert not run.called
+    ...     print(*(w.message for w in caught))
+    ...     with pikepdf.open(output_path) as pdf:
+    ...         print(len(pdf.pages), 'pages')
+
+    The qpdf engine falls back to pikepdf when pdfbook2 or qpdf is missing
+    >>> qpdf_engine(None, False, lambda name: None)
+    pdfbook2 or qpdf not found, falling back to the pikepdf engine
+    3 pages
+    >>> qpdf_engine(None, True, lambda name: name if name == 'pdfbook2' else None)
+    pdfbook2 or qpdf not found, falling back to the pikepdf engine
+    3 pages
+
+    and when pdfbook2 would pad a booklet with a centerfold
+    >>> qpdf_engine(centerfold_path, False, lambda name: name)
+    pdfbook2 would pad this page count with blank pages, falling back to the pikepdf engine
+    4 pages
+    >>> tmp_dir.cleanup()
     """
+    if engine == 'qpdf':
+        with pikepdf.open(input_path) as pdf_reader:
+            total_pages = len(pdf_reader.pages)
+        needs_qpdf = centerfold_path or compress
+        if total_pages % 2 or (centerfold_path and total_pages % 4):
+            warnings.warn("pdfbook2 would pad this page count with blank pages, "
+                          "falling back to the pikepdf engine")
+        elif shutil.which('pdfbook2') and (not needs_qpdf or shutil.which('qpdf')):
+            create_booklet_qpdf(input_path, centerfold_path, output_path, compress)
+            return
+        else:
+            warnings.warn("pdfbook2 or qpdf not found, falling back to the pikepdf engine")
+
     # Create a new PDF writer
-    pdf_writer = PdfWriter()
+    pdf_writer = pikepdf.Pdf.new()
 
-    # Copy the exterior pages
-    with open(input_path, 'rb') as input_file:
-        pdf_reader = PdfReader(input_file)
-        total_pages = len(pdf_reader.pages)
+    # The source documents are memory-mapped and must stay open until the
+    # booklet is saved
+    with ExitStack() as stack:
+        # Copy the exterior pages
+        pdf_reader = stack.enter_context(
+            pikepdf.open(input_path, access_mode=pikepdf.AccessMode.mmap))
+        pages = list(pdf_reader.pages)
+        total_pages = len(pages)
 
         assert total_pages % 2 == 0, "The input PDF must have an even number of pages"
 
-        for i in range(0, total_pages//2, 2):
-            page = page_two_up(pdf_reader.pages[total_pages - i - 1], pdf_reader.pages[i])
-            pdf_writer.add_page(page)
-            i += 1
-            if i < total_pages // 2:
-                page = page_two_up(pdf_reader.pages[i], pdf_reader.pages[total_pages - i - 1])
-                pdf_writer.add_page(page)
-
-    # Copy the centerfold
-    if centerfold_path:
-        with open(centerfold_path, 'rb') as centerfold_file:
-            pdf_reader = PdfReader(centerfold_file)
-            angle = 90
-            for page in pdf_reader.pages:
-                page.rotate(angle)
-                angle *= -1
-                pdf_writer.add_page(page)
-
-    # Save the booklet
-    with open(output_path, 'wb') as output_file:
-        pdf_writer.write(output_file)
+        # Sheets are produced lazily and added to the writer in a single call.
+        # This stays in one process: a sheet only references its source pages,
+        # so building one costs far less than serializing it in a worker, and
+        # per-sheet documents would each carry their own copy of shared fonts.
+        mediaboxes = {}
+        sheets = (page_two_up(pdf_writer, pages[left], pages[right], mediaboxes)
+                  for left, right in imposition_order(total_pages))
+        pdf_writer.pages.extend(sheets)
+
+        # Copy the centerfold
+        if centerfold_path:
+            pdf_reader = stack.enter_context(
+                pikepdf.open(centerfold_path, access_mode=pikepdf.AccessMode.mmap))
+            first = len(pdf_writer.pages)
+            pdf_writer.pages.extend(pdf_reader.pages)
+            angles = [90 if i % 2 == 0 else -90 for i in range(len(pdf_reader.pages))]
+            for page, angle in zip(pdf_writer.pages[first:], angles):
+                # Only the /Rotate entry changes; the content stream is untouched
+                page.obj.Rotate = (int(page.obj.get('/Rotate', 0)) + angle) % 360
+
+        # Save the booklet, packing objects into compressed object streams.
+        # Streams are (re)compressed once here, never per sheet.
+        pdf_writer.save(output_path, linearize=False, recompress_flate=compress,
+                        object_stream_mode=pikepdf.ObjectStreamMode.generate)
 
 
 if __name__ == '__main__':
     """
-    Usage: bl [-h] [-c CENTERFOLD] input_file output_file
+    Usage: bl [-h] [-c CENTERFOLD] [-e {pikepdf,qpdf}] [-z] input_file output_file
 
     Convert a PDF document into booklet form. The resulting PDF will contain half the number
     of pages as the input document, each page twice the size of the input pages.
     E.g., a 4-page 5.5x8.5 input document will result in a 2-page 8.5x11 booklet.
     When printed in flip-on-short-edge mode, the booklet made be folded in half to
     create a 5.5x8.5 booklet.
+
+    With --engine=qpdf the imposition is done by the pdfbook2 and qpdf
+    command-line tools, which must be installed separately.
     """
 
     parser = argparse.ArgumentParser(description='Convert a PDF document into booklet form.')
     parser.add_argument('-c', '--centerfold', help="Add FILE as a centerfold")
+    parser.add_argument('-e', '--engine', choices=['pikepdf', 'qpdf'], default='pikepdf',
+                        help="Impose with pikepdf (default) or with the external "
+                             "pdfbook2 and qpdf tools, which must be installed")
+    parser.add_argument('-z', '--compress', action='store_true',
+                        help="Recompress all streams at the highest level (slower)")
     parser.add_argument('input_file', help='Path to the input PDF document')
     parser.add_argument('output_file', help='Path to save the output booklet PDF')
 
     args = parser.parse_args()
-    create_booklet(args.input_file, args.centerfold, args.output_file)
\ No newline at end of file
+    if args.compress:
+        pikepdf.settings.set_flate_compression_level(9)
+    create_booklet(args.input_file, args.centerfold, args.output_file, args.engine,
+                   args.compress)
\ No newline at end of file